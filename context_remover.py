@@ -12,8 +12,9 @@ class Filter:
 
     def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
 
-        if body["messages"]:
-            body["messages"] = [body["messages"][-1]]
+        messages = body["messages"]
+        if messages:
+            del messages[:-1]
 
         return body
 
@@ -1,18 +1,27 @@
 import csv
+import functools
 import hashlib
 import json
 import os
+import re
+import shutil
+import sys
 import time
+import uuid
 from datetime import datetime
 from decimal import ROUND_HALF_UP, Decimal
-from threading import Lock
+from threading import Event, Lock, Thread
 from typing import Any, Awaitable, Callable, Optional
 import requests
 import tiktoken
-from cachetools import TTLCache, cached
-from open_webui.utils.misc import get_last_assistant_message, get_messages_content
+from cachetools import LRUCache, TTLCache, cached
+from open_webui.utils.misc import (
+    get_content_from_message,
+    get_last_assistant_message,
+)
 from pydantic import BaseModel, Field
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
+from rapidfuzz.distance import Levenshtein
 
 
 class Config:
@@ -21,6 +30,8 @@ class Config:
     CACHE_DIR = os.path.join(DATA_DIR, ".cache")
     CACHE_TTL = 432000  # Cache TTL for 5 days
     CACHE_MAXSIZE = 16
+    REQUEST_TIMEOUT = 30  # seconds to wait for the model pricing json file download
+    TOKEN_CACHE_MAXSIZE = 1024  # number of message digests to remember token counts for
     DECIMALS = "0.00000001"
     DEBUG_PREFIX = "DEBUG:    " + __name__.upper() + " -"
     INFO_PREFIX = "INFO:     " + __name__.upper() + " -"
@@ -29,6 +40,59 @@ class Config:
 
 # Initialize cache
 cache = TTLCache(maxsize=Config.CACHE_MAXSIZE, ttl=Config.CACHE_TTL)
+cache_lock = Lock()
+
+# Provider prefixes and suffixes removed from model names
+_PREFIX_RE = re.compile(r"^(?:openai|github|google_genai|deepseek)/")
+_SUFFIX_RE = re.compile(r"-tuned$")
+
+# Role prefixes at the start of a line
+_ROLE_RE = re.compile(r"^(?:SYSTEM|USER|ASSISTANT|PROMPT):[ \t]*", re.M)
+
+# Trailing version of a model name, e.g. "-20240229", "-v2" or "_1.5"
+_VERSION_SUFFIX_RE = re.compile(r"[-_]v?\d+(\.\d+)*$")
+
+# Encoding used for counting tokens, shared by all requests
+_ENC = tiktoken.get_encoding("cl100k_base")
+
+
+def _get_tmp_path(file_path):
+    # unique per call, so concurrent writers never share a temporary file
+    return f"{file_path}.{uuid.uuid4().hex}.tmp"
+
+
+def _get_digest(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def _write_json_atomic(file_path, data):
+    # write to a temporary file and swap it in, readers never see a half-written file
+    tmp_path = _get_tmp_path(file_path)
+    try:
+        # "x" creates the file with the umask default mode, keep the mode of the old file
+        with open(tmp_path, "x", encoding="UTF-8") as tmp_file:
+            json.dump(data, tmp_file)
+        try:
+            shutil.copymode(file_path, tmp_path)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, file_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _copy_file_atomic(file_path, copy_path):
+    # copy instead of moving, file_path stays readable until it is replaced itself
+    tmp_path = _get_tmp_path(copy_path)
+    try:
+        shutil.copy2(file_path, tmp_path)
+        os.replace(tmp_path, copy_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def get_encoding(model):
@@ -87,15 +151,31 @@ class UserCostManager:
 
 
 class ModelCostManager:
-    _best_match_cache = {}
+    _best_match_cache = None  # loaded lazily from disk, shared by all instances
 
     def __init__(self, cache_dir=Config.CACHE_DIR):
         self.cache_dir = cache_dir
-        self.lock = Lock()
         self.url = "https://raw.githubusercontent.com/BerriAI/litellm/main/model_prices_and_context_window.json"
         self.cache_file_path = self._get_cache_filename()
+        self.match_cache_file_path = os.path.join(self.cache_dir, "model_match.json")
+        self._cost_data = None
+        self._cost_data_mtime = None
+        self._indexed_data = None
+        self._keys = []
+        self._keys_lower = []
+        self._lower_to_orig = {}
+        self._suffix_variants = {}
+        self._decimal_pricing = {}
+        self.session = requests.Session()
+        self._cost_data_ready = Event()
         self._ensure_cache_dir()
 
+        # download the costs json file in the background instead of on the first request
+        if self._get_valid_cache_mtime(self.cache_file_path) is None:
+            Thread(target=self._prefetch_cost_data, daemon=True).start()
+        else:
+            self._cost_data_ready.set()
+
     def _ensure_cache_dir(self):
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
@@ -104,11 +184,53 @@ class ModelCostManager:
         cache_file_name = hashlib.sha256(self.url.encode()).hexdigest() + ".json"
         return os.path.normpath(os.path.join(self.cache_dir, cache_file_name))
 
-    def _is_cache_valid(self, cache_file_path):
-        cache_file_mtime = os.path.getmtime(cache_file_path)
-        return time.time() - cache_file_mtime < cache.ttl
+    def _load_best_match_cache(self):
+        if ModelCostManager._best_match_cache is None:
+            try:
+                with open(
+                    self.match_cache_file_path, "r", encoding="UTF-8"
+                ) as match_file:
+                    ModelCostManager._best_match_cache = json.load(match_file)
+            except (OSError, ValueError):
+                ModelCostManager._best_match_cache = {}
+        return ModelCostManager._best_match_cache
+
+    def _write_best_match_cache(self):
+        try:
+            _write_json_atomic(
+                self.match_cache_file_path, ModelCostManager._best_match_cache
+            )
+        except Exception as e:
+            print(f"**ERROR: Failed to write model match cache file. Error: {e}")
+
+    def _get_valid_cache_mtime(self, cache_file_path):
+        # a single stat call tells both whether the file exists and whether it expired
+        try:
+            cache_file_mtime = os.stat(cache_file_path).st_mtime
+        except FileNotFoundError:
+            return None
+        if time.time() - cache_file_mtime < cache.ttl:
+            return cache_file_mtime
+        return None
+
+    def _read_cost_data(self, cache_file_path):
+        with open(cache_file_path, "rb", buffering=64 * 1024) as cache_file:
+            return json.loads(cache_file.read())
+
+    def _prefetch_cost_data(self):
+        try:
+            self.get_cost_data()
+        except Exception as e:
+            print(f"**ERROR: Failed to prefetch costs json file. Error: {e}")
+        finally:
+            self._cost_data_ready.set()
+
+    def _wait_for_cost_data(self):
+        # wait for a running background download instead of starting a second one
+        self._cost_data_ready.wait(timeout=Config.REQUEST_TIMEOUT)
+        return self.get_cost_data()
 
-    @cached(cache=cache)
+    @cached(cache=cache, lock=cache_lock)
     def get_cost_data(self):
         """
         Fetches a JSON file from a URL and stores it in cache.
@@ -125,183 +247,236 @@ class ModelCostManager:
             requests.RequestException: If the network request fails and no valid cache is available.
         """
 
-        with self.lock:
-            if os.path.exists(self.cache_file_path) and self._is_cache_valid(
-                self.cache_file_path
+        cache_file_mtime = self._get_valid_cache_mtime(self.cache_file_path)
+        if cache_file_mtime is not None:
+            # reuse the already parsed costs when the file did not change on disk
+            if (
+                self._cost_data is not None
+                and self._cost_data_mtime == cache_file_mtime
             ):
-                with open(self.cache_file_path, "r", encoding="UTF-8") as cache_file:
-                    if Config.DEBUG:
-                        print(
-                            f"{Config.DEBUG_PREFIX} Reading costs json file from disk!"
-                        )
-                    return json.load(cache_file)
+                return self._cost_data
+
+            if Config.DEBUG:
+                print(f"{Config.DEBUG_PREFIX} Reading costs json file from disk!")
+            self._cost_data = self._index_cost_data(
+                self._read_cost_data(self.cache_file_path)
+            )
+            self._cost_data_mtime = cache_file_mtime
+            return self._cost_data
         try:
             if Config.DEBUG:
                 print(f"{Config.DEBUG_PREFIX} Downloading model costs json file!")
-            response = requests.get(self.url)
+            response = self.session.get(self.url, timeout=Config.REQUEST_TIMEOUT)
             response.raise_for_status()
             data = response.json()
 
             # backup existing cache file
             try:
-                if os.path.exists(self.cache_file_path):
-                    os.rename(self.cache_file_path, self.cache_file_path + ".bkp")
+                _copy_file_atomic(self.cache_file_path, self.cache_file_path + ".bkp")
+            except FileNotFoundError:
+                pass
             except Exception as e:
                 print(f"**ERROR: Failed to backup costs json file. Error: {e}")
 
-            with self.lock:
-                with open(self.cache_file_path, "w", encoding="UTF-8") as cache_file:
-                    if Config.DEBUG:
-                        print(f"{Config.DEBUG_PREFIX} Writing costs to json file!")
-                    json.dump(data, cache_file)
+            if Config.DEBUG:
+                print(f"{Config.DEBUG_PREFIX} Writing costs to json file!")
+            _write_json_atomic(self.cache_file_path, data)
+            self._cost_data = self._index_cost_data(data)
+            self._cost_data_mtime = os.path.getmtime(self.cache_file_path)
+
+            # model names may resolve differently against the new costs json file
+            ModelCostManager._best_match_cache = {}
+            self._write_best_match_cache()
 
             return data
         except Exception as e:
             print(
                 f"**ERROR: Failed to download or write to costs json file. Using old cached file if available. Error: {e}"
             )
-            with self.lock:
-                if os.path.exists(self.cache_file_path + ".bkp"):
-                    with open(
-                        self.cache_file_path + ".bkp", "r", encoding="UTF-8"
-                    ) as cache_file:
-                        if Config.DEBUG:
-                            print(
-                                f"{Config.DEBUG_PREFIX} Reading costs json file from backup!"
-                            )
-                        return json.load(cache_file)
-                else:
-                    raise e
-
-    def levenshtein_distance(self, s1, s2):
-        m, n = len(s1), len(s2)
-        dp = [[0] * (n + 1) for _ in range(m + 1)]
-
-        for i in range(m + 1):
-            dp[i][0] = i
-        for j in range(n + 1):
-            dp[0][j] = j
-
-        for i in range(1, m + 1):
-            for j in range(1, n + 1):
-                cost = 0 if s1[i - 1] == s2[j - 1] else 1
-                dp[i][j] = min(
-                    dp[i - 1][j] + 1, dp[i][j - 1] + 1, dp[i - 1][j - 1] + cost
-                )
-
-        return dp[m][n]
+            try:
+                backup_data = self._read_cost_data(self.cache_file_path + ".bkp")
+            except FileNotFoundError:
+                raise e
+            if Config.DEBUG:
+                print(f"{Config.DEBUG_PREFIX} Reading costs json file from backup!")
+            return self._index_cost_data(backup_data)
+
+    def _index_cost_data(self, json_data):
+        # Lowercase the pricing keys once per loaded costs json instead of per lookup
+        self._keys = list(json_data.keys())
+        self._keys_lower = [key.lower() for key in self._keys]
+        self._lower_to_orig = dict(zip(self._keys_lower, self._keys))
+        # map version-less names to the first pricing key carrying that name
+        self._suffix_variants = {}
+        for key_lower, key in zip(self._keys_lower, self._keys):
+            self._suffix_variants.setdefault(_VERSION_SUFFIX_RE.sub("", key_lower), key)
+        self._decimal_pricing = {}
+        self._indexed_data = json_data
+        return json_data
 
     def _find_best_match(self, query: str, json_data) -> str:
+        if self._indexed_data is not json_data:
+            self._index_cost_data(json_data)
+
         # Exact match search
         query_lower = query.lower()
-        keys_lower = {key.lower(): key for key in json_data.keys()}
 
-        if query_lower in keys_lower:
-            return keys_lower[query_lower]
+        if query_lower in self._lower_to_orig:
+            return self._lower_to_orig[query_lower]
+
+        # Match against pricing keys with their version suffix stripped
+        if query_lower in self._suffix_variants:
+            return self._suffix_variants[query_lower]
 
-        # If no exact match is found, try fuzzy partial matching
+        # If no exact match is found, try fuzzy matching
         start = time.time()
-        partial_ratios = [(fuzz.ratio(key, query_lower), key) for key in keys_lower]
-        best_match, best_key = max(partial_ratios, key=lambda x: x[0])
+        match = process.extractOne(
+            query_lower, self._keys_lower, scorer=fuzz.ratio, score_cutoff=79
+        )
         end = time.time()
         if Config.DEBUG:
+            best_ratio = match[1] if match is not None else "below 79"
             print(
-                f"{Config.DEBUG_PREFIX} Best fuzzy match for query '{query}' is '{best_key}' with ratio {best_match:.1f} in {end - start:.4f} seconds"
+                f"{Config.DEBUG_PREFIX} Best fuzzy match ratio for query '{query}' was {best_ratio} in {end - start:.4f} seconds"
             )
-        if best_match >= 79:
-            return best_key
+        if match is not None:
+            return self._keys[match[2]]
 
         # Fallback to Levenshtein distance matching as a last resort
         threshold_ratio = 0.6 if len(query) < 15 else 0.3
-        min_distance = float("inf")
-        best_match = None
         threshold = round(len(query) * threshold_ratio)
 
         start = time.time()
-        distances = (self.levenshtein_distance(query_lower, key) for key in keys_lower)
-        for key, dist in zip(keys_lower.values(), distances):
-            if dist < min_distance:
-                min_distance = dist
-                best_match = key
-            if dist < 2:  # Early termination for (almost) exact match
-                return key
+        # keys whose length differs by more than the threshold can never be within it
+        query_length = len(query_lower)
+        candidates = [
+            (key, key_lower)
+            for key, key_lower in zip(self._keys, self._keys_lower)
+            if abs(len(key_lower) - query_length) <= threshold
+        ]
+        match = process.extractOne(
+            query_lower,
+            [key_lower for _, key_lower in candidates],
+            scorer=Levenshtein.distance,
+            score_cutoff=threshold,
+        )
         end = time.time()
         if Config.DEBUG:
+            min_distance = match[1] if match is not None else f"above {threshold}"
             print(
                 f"{Config.DEBUG_PREFIX} Levenshtein min. distance was {min_distance}. Search took {end - start:.3f} seconds"
             )
 
-        if min_distance <= threshold:
-            return best_match
+        if match is not None:
+            return candidates[match[2]][0]
 
         # Final fallback: try fuzz.partial_ratio
         start = time.time()
-        partial_ratios = [
-            (fuzz.partial_ratio(key, query_lower), key) for key in keys_lower
-        ]
-        best_ratio, best_key = max(partial_ratios, key=lambda x: x[0])
+        match = process.extractOne(
+            query_lower, self._keys_lower, scorer=fuzz.partial_ratio, score_cutoff=80
+        )
         end = time.time()
         if Config.DEBUG:
+            best_ratio = match[1] if match is not None else "below 80"
             print(
-                f"{Config.DEBUG_PREFIX} Best partial ratio match for query '{query}' is '{best_key}' with ratio {best_ratio:.1f} in {end - start:.4f} seconds"
+                f"{Config.DEBUG_PREFIX} Best partial ratio match for query '{query}' was {best_ratio} in {end - start:.4f} seconds"
             )
-        if best_ratio >= 80:  # Threshold for partial ratio
-            return best_key
+        if match is not None:  # Threshold for partial ratio
+            return self._keys[match[2]]
 
         return None
 
-    def get_model_data(self, model):
-        json_data = self.get_cost_data()
+    def _get_best_match(self, model, json_data):
+        best_match_cache = self._load_best_match_cache()
 
-        if model in ModelCostManager._best_match_cache:
+        if model in best_match_cache and (
+            best_match_cache[model] is None or best_match_cache[model] in json_data
+        ):
             if Config.DEBUG:
                 print(
                     f"{Config.DEBUG_PREFIX} Using cached costs for model named '{model}'"
                 )
-            best_match = ModelCostManager._best_match_cache[model]
+            best_match = best_match_cache[model]
         else:
             if Config.DEBUG:
                 print(
                     f"{Config.DEBUG_PREFIX} Searching best match in costs file for model named '{model}'"
                 )
             best_match = self._find_best_match(model, json_data)
-            ModelCostManager._best_match_cache[model] = best_match
+            best_match_cache[model] = best_match
+            self._write_best_match_cache()
+
+        if best_match is not None and Config.DEBUG:
+            print(f"{Config.DEBUG_PREFIX} Using costs from '{best_match}'")
+
+        return best_match
+
+    def get_model_data(self, model):
+        json_data = self._wait_for_cost_data()
+        best_match = self._get_best_match(model, json_data)
 
         if best_match is None:
             return {}
 
-        if Config.DEBUG:
-            print(f"{Config.DEBUG_PREFIX} Using costs from '{best_match}'")
-
         return json_data.get(best_match, {})
 
+    def get_model_pricing(self, model):
+        """Returns the input and output cost per token of a model as Decimals
+
+        Args:
+            model (str): model name
+
+        Returns:
+            tuple: (input_cost_per_token, output_cost_per_token) or None if the model is not found
+        """
+        json_data = self._wait_for_cost_data()
+        best_match = self._get_best_match(model, json_data)
+
+        if best_match is None or not json_data.get(best_match):
+            return None
+
+        if best_match not in self._decimal_pricing:
+            model_pricing_data = json_data[best_match]
+            self._decimal_pricing[best_match] = (
+                Decimal(str(model_pricing_data.get("input_cost_per_token", 0))),
+                Decimal(str(model_pricing_data.get("output_cost_per_token", 0))),
+            )
+
+        return self._decimal_pricing[best_match]
+
 
 class CostCalculator:
+    NO_PRICING = (Decimal(0), Decimal(0))
+
     def __init__(
         self, user_cost_manager: UserCostManager, model_cost_manager: ModelCostManager
     ):
         self.model_cost_manager = model_cost_manager
         self.user_cost_manager = user_cost_manager
+        self.decimals = Decimal(Config.DECIMALS)
+        self._compensation = None
+        self._compensation_decimal = None
+
+    def _get_compensation(self, compensation: float) -> Decimal:
+        # the compensation valve rarely changes, only convert it when it does
+        if compensation != self._compensation:
+            self._compensation = compensation
+            self._compensation_decimal = Decimal(str(float(compensation)))
+        return self._compensation_decimal
 
     def calculate_costs(
         self, model: str, input_tokens: int, output_tokens: int, compensation: float
     ) -> Decimal:
-        model_pricing_data = self.model_cost_manager.get_model_data(model)
-        if not model_pricing_data:
+        model_pricing = self.model_cost_manager.get_model_pricing(model)
+        if model_pricing is None:
             print(f"{Config.INFO_PREFIX} Model '{model}' not found in costs json file!")
-        input_cost_per_token = Decimal(
-            str(model_pricing_data.get("input_cost_per_token", 0))
-        )
-        output_cost_per_token = Decimal(
-            str(model_pricing_data.get("output_cost_per_token", 0))
-        )
+            model_pricing = self.NO_PRICING
+        input_cost_per_token, output_cost_per_token = model_pricing
 
         input_cost = input_tokens * input_cost_per_token
         output_cost = output_tokens * output_cost_per_token
-        total_cost = Decimal(float(compensation)) * (input_cost + output_cost)
-        total_cost = total_cost.quantize(
-            Decimal(Config.DECIMALS), rounding=ROUND_HALF_UP
-        )
+        total_cost = self._get_compensation(compensation) * (input_cost + output_cost)
+        total_cost = total_cost.quantize(self.decimals, rounding=ROUND_HALF_UP)
 
         return total_cost
 
@@ -332,9 +507,12 @@ class Filter:
         )
         self.start_time = None
         self.input_tokens = 0
+        self.token_counts = LRUCache(maxsize=Config.TOKEN_CACHE_MAXSIZE)
         pass
 
-    def _sanitize_model_name(self, name: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def _sanitize_model_name(name: str) -> str:
         """Sanitize model name by removing prefixes and suffixes
 
         Args:
@@ -343,29 +521,28 @@ class Filter:
         Returns:
             str: sanitized model name
         """
-        prefixes = ["openai/", "github/", "google_genai/", "deepseek/"]
-        suffixes = ["-tuned"]
-        # remove prefixes and suffixes
-        for prefix in prefixes:
-            if name.startswith(prefix):
-                name = name[len(prefix) :]
-        for suffix in suffixes:
-            if name.endswith(suffix):
-                name = name[: -len(suffix)]
-        return name.lower().strip()
+        # interned, so every cache keyed by model name shares one string per model
+        return sys.intern(_SUFFIX_RE.sub("", _PREFIX_RE.sub("", name)).lower().strip())
 
     def _remove_roles(self, content):
-        # Define the roles to be removed
-        roles = ["SYSTEM:", "USER:", "ASSISTANT:", "PROMPT:"]
-
-        # Process each line
-        def process_line(line):
-            for role in roles:
-                if line.startswith(role):
-                    return line.split(":", 1)[1].strip()
-            return line  # Return the line unchanged if no role matches
-
-        return "\n".join([process_line(line) for line in content.split("\n")])
+        return _ROLE_RE.sub("", content)
+
+    def _count_tokens(self, texts):
+        # earlier turns of a conversation are sent again with every request, only
+        # encode the texts that have not been counted yet, all in one batch. The
+        # cache is keyed by a digest so it never keeps message texts alive.
+        digests = [_get_digest(text) for text in texts]
+        counts = {digest: self.token_counts.get(digest) for digest in digests}
+        missing = {
+            digest: text
+            for digest, text in zip(digests, texts)
+            if counts[digest] is None
+        }
+        if missing:
+            encoded = _ENC.encode_ordinary_batch(list(missing.values()))
+            for digest, tokens in zip(missing, encoded):
+                counts[digest] = self.token_counts[digest] = len(tokens)
+        return sum(counts[digest] for digest in digests)
 
     def _get_model(self, body):
         if "model" in body:
@@ -381,11 +558,12 @@ class Filter:
     ) -> dict:
 
         Config.DEBUG = self.valves.debug
-        enc = tiktoken.get_encoding("cl100k_base")
-        input_content = self._remove_roles(
-            get_messages_content(body["messages"])
-        ).strip()
-        self.input_tokens = len(enc.encode(input_content))
+        self.input_tokens = self._count_tokens(
+            [
+                self._remove_roles(get_content_from_message(message) or "").strip()
+                for message in body["messages"]
+            ]
+        )
 
         await __event_emitter__(
             {
@@ -432,8 +610,12 @@ class Filter:
         )
 
         model = self._get_model(body)
-        enc = tiktoken.get_encoding("cl100k_base")
-        output_tokens = len(enc.encode(get_last_assistant_message(body["messages"])))
+        assistant_message = get_last_assistant_message(body["messages"]) or ""
+        output_tokens = self._count_tokens([assistant_message])
+        # inlet counts the reply without roles, so the next request reuses this count
+        self.token_counts[
+            _get_digest(self._remove_roles(assistant_message).strip())
+        ] = output_tokens
 
         await __event_emitter__(
             {
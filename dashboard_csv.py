@@ -8,21 +8,31 @@ app = dash.Dash(__name__)
 
 # Load data from the CSV file
 file_path = "/home/yhs/data/costs.csv"  # Update this with your file path
-df = pd.read_csv(file_path)
+df = pd.read_csv(file_path, dtype={"user": "category", "model": "category"})
 
 # Convert timestamp to datetime
 df["timestamp"] = pd.to_datetime(df["timestamp"])
 
-# Calculate summaries
+# Calculate summaries once and share them between the graphs
 user_summary = (
-    df.groupby("user")
+    df.groupby("user", observed=True)
     .agg(
         total_input_tokens=("input_tokens", "sum"),
         total_output_tokens=("output_tokens", "sum"),
         total_cost=("total_cost", "sum"),
+        avg_cost=("total_cost", "mean"),
+        avg_tokens=("input_tokens", "mean"),
+        transaction_count=("total_cost", "size"),
     )
     .reset_index()
 )
+user_time_summary = (
+    df.groupby(["timestamp", "user"], observed=True)[
+        ["input_tokens", "output_tokens", "total_cost"]
+    ]
+    .sum()
+    .reset_index()
+)
 
 
 # Visualization Functions
@@ -67,9 +77,8 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig5))
 
     # 6. Tokens Over Time (Line Chart)
-    tokens_df = df.groupby(["timestamp", "user"]).sum().reset_index()
     fig6 = px.line(
-        tokens_df,
+        user_time_summary,
         x="timestamp",
         y="input_tokens",
         color="user",
@@ -78,9 +87,8 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig6))
 
     # 7. Average Cost Per Transaction by User
-    avg_cost = df.groupby("user").agg(avg_cost=("total_cost", "mean")).reset_index()
     fig7 = px.bar(
-        avg_cost, x="user", y="avg_cost", title="Average Cost per Transaction"
+        user_summary, x="user", y="avg_cost", title="Average Cost per Transaction"
     )
     graphs.append(dcc.Graph(figure=fig7))
 
@@ -89,7 +97,9 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig8))
 
     # 9. Model Usage by User
-    model_summary = df.groupby(["user", "model"]).size().reset_index(name="count")
+    model_summary = (
+        df.groupby(["user", "model"], observed=True).size().reset_index(name="count")
+    )
     fig9 = px.bar(
         model_summary,
         x="user",
@@ -119,29 +129,27 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig11))
 
     # 12. Cost by Model (Bar Chart)
-    model_cost = df.groupby("model").agg(total_cost=("total_cost", "sum")).reset_index()
+    model_cost = (
+        df.groupby("model", observed=True)
+        .agg(total_cost=("total_cost", "sum"))
+        .reset_index()
+    )
     fig12 = px.bar(model_cost, x="model", y="total_cost", title="Total Cost by Model")
     graphs.append(dcc.Graph(figure=fig12))
 
     # 13. User Token Usage Over Time (Line Chart)
-    user_time_df = (
-        df.groupby(["timestamp", "user"])
-        .agg(total_tokens=("input_tokens", "sum"))
-        .reset_index()
-    )
     fig13 = px.line(
-        user_time_df,
+        user_time_summary,
         x="timestamp",
-        y="total_tokens",
+        y="input_tokens",
         color="user",
         title="User Token Usage Over Time",
     )
     graphs.append(dcc.Graph(figure=fig13))
 
     # 14. Total Number of Transactions by User
-    transaction_count = df.groupby("user").size().reset_index(name="transaction_count")
     fig14 = px.bar(
-        transaction_count,
+        user_summary,
         x="user",
         y="transaction_count",
         title="Total Transactions by User",
@@ -159,11 +167,8 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig15))
 
     # 16. Average Tokens Per Transaction by User
-    avg_tokens = (
-        df.groupby("user").agg(avg_tokens=("input_tokens", "mean")).reset_index()
-    )
     fig16 = px.bar(
-        avg_tokens, x="user", y="avg_tokens", title="Average Tokens Per Transaction"
+        user_summary, x="user", y="avg_tokens", title="Average Tokens Per Transaction"
     )
     graphs.append(dcc.Graph(figure=fig16))
 
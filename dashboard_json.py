@@ -10,78 +10,167 @@ app = dash.Dash(__name__)
 
 
 # Load and process JSON data
+import concurrent.futures
 import os
 import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+
+# total_cost is written as a decimal string by the cost tracker
+SCHEMA = pa.schema(
+    [
+        ("user", pa.string()),
+        ("model", pa.string()),
+        ("timestamp", pa.string()),
+        ("input_tokens", pa.int32()),
+        ("output_tokens", pa.int32()),
+        ("total_cost", pa.string()),
+    ]
+)
+DEFAULTS = {
+    "user": "unknown",
+    "model": "unknown",
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "total_cost": "0.0",
+}
+
+
+def _records_to_table(records):
+    for record in records:
+        if record.get("total_cost") is not None:
+            record["total_cost"] = str(record["total_cost"])
+    return pa.Table.from_pylist(records, schema=SCHEMA)
+
+
+def _parse_legacy_file(file_path):
+    # costs json files written before the switch to JSON Lines hold a single list of
+    # records, or a dict mapping each user to their records (empty if none was written)
+    with open(file_path, "r") as file:
+        json_data = json.load(file)
+
+    filename = os.path.basename(file_path)
+    if isinstance(json_data, dict):
+        records = []
+        for user, user_records in json_data.items():
+            if isinstance(user_records, list):
+                records.extend(
+                    dict(record, user=user)
+                    for record in user_records
+                    if isinstance(record, dict)
+                )
+            else:
+                print(
+                    f"Skipping records for user {user}, expected list but got {type(user_records)}"
+                )
+    elif isinstance(json_data, list):
+        records = [record for record in json_data if isinstance(record, dict)]
+    else:
+        print(
+            f"Invalid JSON structure in {filename}, expected list or dictionary at top level."
+        )
+        records = []
+    return _records_to_table(records)
+
+
+def _parse_file(file_path):
+    # Line by line fallback for files the arrow reader rejects, e.g. a truncated last line
+    filename = os.path.basename(file_path)
+    records = []
+    with open(file_path, "r") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping invalid JSON on line {line_number} in {filename}")
+                continue
+
+            records.append(record)
+
+    return _records_to_table(records)
+
+
+def _read_file(file_path):
+    if file_path.endswith(".json"):
+        return _parse_legacy_file(file_path)
+    try:
+        return pj.read_json(
+            file_path,
+            parse_options=pj.ParseOptions(
+                explicit_schema=SCHEMA, unexpected_field_behavior="ignore"
+            ),
+        )
+    except pa.ArrowInvalid:
+        return _parse_file(file_path)
+
+
+def _load_file(file_path):
+    filename = os.path.basename(file_path)
+    try:
+        table = _read_file(file_path)
+        print(f"Successfully read {filename}")
+        return table
+    except Exception as e:
+        print(f"Error reading {filename}: {e}")
+        return None
 
 
 def load_json_files(folder_path):
-    data = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".json"):
-            try:
-                with open(os.path.join(folder_path, filename), "r") as file:
-                    json_data = json.load(file)
-
-                    if isinstance(json_data, dict):
-                        for user, records in json_data.items():
-                            if isinstance(records, list):
-                                for record in records:
-                                    data.append(
-                                        {
-                                            "user": user,
-                                            "model": record.get("model", "unknown"),
-                                            "timestamp": record.get(
-                                                "timestamp", "unknown"
-                                            ),
-                                            "input_tokens": record.get(
-                                                "input_tokens", 0
-                                            ),
-                                            "output_tokens": record.get(
-                                                "output_tokens", 0
-                                            ),
-                                            "total_cost": float(
-                                                record.get("total_cost", 0.0)
-                                            ),
-                                        }
-                                    )
-                            else:
-                                print(
-                                    f"Skipping records for user {user}, expected list but got {type(records)}"
-                                )
-                    else:
-                        print(
-                            f"Invalid JSON structure in {filename}, expected dictionary at top level."
-                        )
-
-                print(f"Successfully read {filename}")
-            except Exception as e:
-                print(f"Error reading {filename}: {e}")
-
-    return pd.DataFrame(data)
-
-
-# Load data from the folder containing the .json files
-folder_path = "/home/yhs/data"  # Update this with your folder path
-df = load_json_files(folder_path)
-
-# Convert timestamp to datetime
-df["timestamp"] = pd.to_datetime(df["timestamp"])
-
-# Calculate summaries
-user_summary = (
-    df.groupby("user")
-    .agg(
-        total_input_tokens=("input_tokens", "sum"),
-        total_output_tokens=("output_tokens", "sum"),
-        total_cost=("total_cost", "sum"),
-    )
-    .reset_index()
-)
+    file_paths = [
+        os.path.join(folder_path, filename)
+        for filename in os.listdir(folder_path)
+        if filename.endswith(".jsonl")
+        or (filename.startswith("costs-") and filename.endswith(".json"))
+    ]
+
+    # pyarrow releases the GIL while parsing, so threads read the files in parallel
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        tables = [
+            table for table in executor.map(_load_file, file_paths) if table is not None
+        ]
+
+    table = pa.concat_tables(tables) if tables else SCHEMA.empty_table()
+
+    for name, default in DEFAULTS.items():
+        column = pc.fill_null(table[name], default)
+        if name == "total_cost":
+            column = pc.cast(column, pa.float64())
+        elif name in ("user", "model"):
+            # dictionary encoded columns are converted to pandas categories
+            column = pc.dictionary_encode(column)
+        table = table.set_column(table.schema.get_field_index(name), name, column)
+
+    return table.to_pandas()
 
 
 # Visualization Functions
 def create_graphs(df):
+    # Calculate summaries once and share them between the graphs
+    user_summary = (
+        df.groupby("user", observed=True)
+        .agg(
+            total_input_tokens=("input_tokens", "sum"),
+            total_output_tokens=("output_tokens", "sum"),
+            total_cost=("total_cost", "sum"),
+            avg_cost=("total_cost", "mean"),
+            avg_tokens=("input_tokens", "mean"),
+            transaction_count=("total_cost", "size"),
+        )
+        .reset_index()
+    )
+    user_time_summary = (
+        df.groupby(["timestamp", "user"], observed=True)[
+            ["input_tokens", "output_tokens", "total_cost"]
+        ]
+        .sum()
+        .reset_index()
+    )
+
     graphs = []
 
     # 1. Total Input Tokens by User
@@ -122,9 +211,8 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig5))
 
     # 6. Tokens Over Time (Line Chart)
-    tokens_df = df.groupby(["timestamp", "user"]).sum().reset_index()
     fig6 = px.line(
-        tokens_df,
+        user_time_summary,
         x="timestamp",
         y="input_tokens",
         color="user",
@@ -133,9 +221,8 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig6))
 
     # 7. Average Cost Per Transaction by User
-    avg_cost = df.groupby("user").agg(avg_cost=("total_cost", "mean")).reset_index()
     fig7 = px.bar(
-        avg_cost, x="user", y="avg_cost", title="Average Cost per Transaction"
+        user_summary, x="user", y="avg_cost", title="Average Cost per Transaction"
     )
     graphs.append(dcc.Graph(figure=fig7))
 
@@ -144,7 +231,9 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig8))
 
     # 9. Model Usage by User
-    model_summary = df.groupby(["user", "model"]).size().reset_index(name="count")
+    model_summary = (
+        df.groupby(["user", "model"], observed=True).size().reset_index(name="count")
+    )
     fig9 = px.bar(
         model_summary,
         x="user",
@@ -174,29 +263,27 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig11))
 
     # 12. Cost by Model (Bar Chart)
-    model_cost = df.groupby("model").agg(total_cost=("total_cost", "sum")).reset_index()
+    model_cost = (
+        df.groupby("model", observed=True)
+        .agg(total_cost=("total_cost", "sum"))
+        .reset_index()
+    )
     fig12 = px.bar(model_cost, x="model", y="total_cost", title="Total Cost by Model")
     graphs.append(dcc.Graph(figure=fig12))
 
     # 13. User Token Usage Over Time (Line Chart)
-    user_time_df = (
-        df.groupby(["timestamp", "user"])
-        .agg(total_tokens=("input_tokens", "sum"))
-        .reset_index()
-    )
     fig13 = px.line(
-        user_time_df,
+        user_time_summary,
         x="timestamp",
-        y="total_tokens",
+        y="input_tokens",
         color="user",
         title="User Token Usage Over Time",
     )
     graphs.append(dcc.Graph(figure=fig13))
 
     # 14. Total Number of Transactions by User
-    transaction_count = df.groupby("user").size().reset_index(name="transaction_count")
     fig14 = px.bar(
-        transaction_count,
+        user_summary,
         x="user",
         y="transaction_count",
         title="Total Transactions by User",
@@ -214,32 +301,36 @@ def create_graphs(df):
     graphs.append(dcc.Graph(figure=fig15))
 
     # 16. Average Tokens Per Transaction by User
-    avg_tokens = (
-        df.groupby("user").agg(avg_tokens=("input_tokens", "mean")).reset_index()
-    )
     fig16 = px.bar(
-        avg_tokens, x="user", y="avg_tokens", title="Average Tokens Per Transaction"
+        user_summary, x="user", y="avg_tokens", title="Average Tokens Per Transaction"
     )
     graphs.append(dcc.Graph(figure=fig16))
 
     return graphs
 
 
-# Create the dashboard layout
-app.layout = html.Div(
-    [
-        html.H1("User Token and Cost Dashboard"),
-        html.Div(
-            create_graphs(df),
-            style={
-                "display": "grid",
-                "grid-template-columns": "repeat(4, 1fr)",  # 4 graphs per row for 16 graphs
-                "gap": "20px",
-            },
-        ),
-    ]
-)
-
-# Run the app
 if __name__ == "__main__":
+    # Load data from the folder containing the .jsonl (and legacy .json) files
+    folder_path = "/home/yhs/data"  # Update this with your folder path
+    df = load_json_files(folder_path)
+
+    # Convert timestamp to datetime
+    df["timestamp"] = pd.to_datetime(df["timestamp"])
+
+    # Create the dashboard layout
+    app.layout = html.Div(
+        [
+            html.H1("User Token and Cost Dashboard"),
+            html.Div(
+                create_graphs(df),
+                style={
+                    "display": "grid",
+                    "grid-template-columns": "repeat(4, 1fr)",  # 4 graphs per row for 16 graphs
+                    "gap": "20px",
+                },
+            ),
+        ]
+    )
+
+    # Run the app
     app.run_server(debug=False)